@@ -3,6 +3,8 @@
 #
 # Usage: process-otu-data.py INPUT-FILE OUTPUT-FILE
 #
+# Requires numpy, requests and urllib3 2 or later.
+#
 # This script processes files containing data on relative abundance of OTUs in
 # one or more samples.
 #
@@ -20,7 +22,23 @@
 # OTU has less than PRUNING_VALUE times as many reads in a sample as in the
 # buffer, its presence is attributed to contamination and the number of hits is
 # adjusted to zero. PRUNING_VALUE has been set to 1.5 by default, but may be
-# changed.
+# changed. If every OTU in a sample is pruned, the sample has no proportions
+# and the script stops with an error naming it.
+#
+# Species are looked up OTL_MAX_REQUESTS at a time on worker threads, 8 by
+# default, which keeps the load on the Open Tree of Life API modest.
+#
+# Open Tree of Life lookups are cached in OTL_CACHE_FILE so that repeated runs on
+# the same OTUs do not query the API again. Delete the cache file to force fresh
+# lookups.
+#
+# If OTT_TAXONOMY_FILE is set to the taxonomy.tsv file of a downloaded Open Tree
+# Taxonomy release (https://tree.opentreeoflife.org/about/taxonomy-version),
+# names are resolved against it first and only names not found there are looked
+# up through the API. Taxa that the API would not match, such as environmental
+# samples, are left out. The first run builds an index of the file in
+# OTT_TAXONOMY_FILE.db, which takes several minutes and around as much disk space
+# as the file itself; later runs reuse it until the file changes.
 #
 # Open Tree of Life API code is based on https://github.com/brunoasm/TaxReformer
 #
@@ -28,76 +46,303 @@
 # Adjustable pruning value
 PRUNING_VALUE = 1.5
 
+# Adjustable number of species looked up at once through the Open Tree of Life API
+OTL_MAX_REQUESTS = 8
+
+# Adjustable file for caching Open Tree of Life lookups between runs
+OTL_CACHE_FILE = 'otl_cache.sqlite'
+
+# Adjustable path to a local Open Tree Taxonomy taxonomy.tsv, or None to use
+# only the Open Tree of Life API
+OTT_TAXONOMY_FILE = None
+
 
-import csv, requests, sys, time, warnings
-from requests.exceptions import ConnectionError, SSLError
-from numpy import nan
+import concurrent.futures, csv, functools, os, pickle, requests, sqlite3, sys, threading, warnings
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, RetryError, Timeout
+from urllib3.util.retry import Retry
+import numpy as np
 
 
 # convert Open Tree of Life taxonomy results into dictionary
-list2dict = lambda taxlist : {x.split(':')[0] : x.split(':')[1] for x in taxlist}
+def list2dict(taxlist):
+    return {source : source_id for source, _, source_id in (x.partition(':') for x in taxlist)}
 
 
-# query Open Tree of Life's taxonomic resolution services
-def otl_tnrs(query, do_approximate = True, wait_time = 600):
-    contact_otl = True
+# shared connection pool for Open Tree of Life requests, retrying failed
+# connections and server errors with exponential backoff
+otl_session = requests.Session()
+otl_session.mount('https://', HTTPAdapter(pool_connections = 16, pool_maxsize = 16,
+        max_retries = Retry(total = 8, backoff_factor = 1.5, backoff_jitter = 1,
+                status_forcelist = [429, 500, 502, 503, 504], allowed_methods = None)))
 
-    while contact_otl:
-        try:
-            res = requests.post('https://api.opentreeoflife.org/v3/tnrs/match_names',
-                    json = {'names' : [query, query], 'do_approximate_matching' : do_approximate})
-        except (SSLError, ConnectionError):
-            sys.stderr.write(time.ctime() + ': error connecting to Open Tree of Life, retrying in ' + str(wait_time) + ' seconds')
-            time.sleep(wait_time)
-            continue
+# set once a request has used up its retries, after which Open Tree of Life is not
+# contacted again for the rest of the run
+otl_unavailable = threading.Event()
 
-        if res.status_code == 200:
-            contact_otl = False
-        else:
-            sys.stderr.write(time.ctime() + ': error with Open Tree of Life response, retrying in ' + str(wait_time) + ' seconds')
-            time.sleep(wait_time)
-            continue
+
+# post a query to Open Tree of Life, giving up on the API for the rest of the run
+# once a request has used up its retries
+def otl_post(url, query):
+    if otl_unavailable.is_set():
+        raise ConnectionError('Open Tree of Life is unavailable')
+
+    try:
+        return otl_session.post(url, json = query, timeout = 30)
+    except (ConnectionError, RetryError, Timeout):
+        if not otl_unavailable.is_set():
+            otl_unavailable.set()
+            sys.stderr.write('error contacting Open Tree of Life, leaving remaining names unresolved\n')
+        raise
+
+
+# open an sqlite cache of Open Tree of Life lookups, usable from any thread while
+# holding otl_cache_lock
+def open_otl_cache(file):
+    db = sqlite3.connect(file, check_same_thread = False)
+    db.execute('CREATE TABLE IF NOT EXISTS lookups (query TEXT PRIMARY KEY, result BLOB)')
+    return db
+
+
+# cache of Open Tree of Life lookups, replaced by one on OTL_CACHE_FILE when run as
+# a script
+otl_cache = open_otl_cache(':memory:')
+otl_cache_lock = threading.Lock()
+
+
+# check whether a lookup is in otl_cache; call while holding otl_cache_lock
+def otl_cache_has(key):
+    return otl_cache.execute('SELECT 1 FROM lookups WHERE query = ?', (key,)).fetchone() is not None
+
+
+# get a lookup from otl_cache as a (found, result) pair; call while holding
+# otl_cache_lock
+def otl_cache_get(key):
+    row = otl_cache.execute('SELECT result FROM lookups WHERE query = ?', (key,)).fetchone()
+    return (True, pickle.loads(row[0])) if row else (False, None)
+
+
+# store a lookup in otl_cache; call while holding otl_cache_lock
+def otl_cache_put(key, result):
+    otl_cache.execute('INSERT OR REPLACE INTO lookups VALUES (?, ?)', (key, pickle.dumps(result)))
+
+
+# store results of an Open Tree of Life lookup in otl_cache under prefix:query
+def otl_cached(prefix):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(query):
+            key = prefix + ':' + str(query)
+
+            with otl_cache_lock:
+                found, result = otl_cache_get(key)
+            if found:
+                return result
+
+            result = func(query)
+
+            with otl_cache_lock:
+                otl_cache_put(key, result)
+            return result
+        return wrapper
+    return decorator
+
+
+# flags of taxa that Open Tree of Life's TNRS does not match
+tnrs_suppressed_flags = {'not_otu', 'environmental', 'environmental_inherited', 'viral', 'hidden',
+        'hidden_inherited', 'was_container', 'barren'}
+
+
+# index of the local Open Tree Taxonomy, opened from OTT_TAXONOMY_FILE when run as
+# a script
+ott_db = None
+ott_db_lock = threading.Lock()
+
+
+# convert a line of an Open Tree Taxonomy taxonomy.tsv into a row of the index
+def ott_index_row(line):
+    fields = line.split('\t|\t')
+    uid, parent, name, rank, sourceinfo, uniqname = fields[:6]
+    flags = fields[6].rstrip('\t|\r\n').split(',') if len(fields) > 6 else []
+    suppressed = any(flag in tnrs_suppressed_flags for flag in flags)
+
+    return int(uid), int(parent) if parent else None, name, rank, sourceinfo, uniqname, suppressed, name.lower()
+
+
+# build an sqlite index of an Open Tree Taxonomy taxonomy.tsv, matching names only
+# to taxa that TNRS would match and leaving out names shared by more than one
+def build_ott_index(file, index):
+    tmp = index + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    db = sqlite3.connect(tmp)
+    db.execute('CREATE TABLE taxa (ott_id INTEGER PRIMARY KEY, parent INTEGER, name TEXT, rank TEXT, '
+            'sourceinfo TEXT, uniqname TEXT, suppressed INTEGER, name_lower TEXT)')
+
+    with open(file, newline='') as tsvfile:
+        next(tsvfile)
+        db.executemany('INSERT INTO taxa VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (ott_index_row(line) for line in tsvfile))
+
+    db.execute('CREATE TABLE names (name TEXT PRIMARY KEY, ott_id INTEGER)')
+    db.execute('INSERT INTO names SELECT name_lower, max(ott_id) FROM taxa WHERE NOT suppressed '
+            'GROUP BY name_lower HAVING count(*) = 1')
+    db.commit()
+    db.close()
+
+    # only replace the index once it is complete
+    os.replace(tmp, index)
+
+
+# open the index of an Open Tree Taxonomy taxonomy.tsv, building it next to the
+# file on first use or when the file is newer
+def open_ott_taxonomy(file):
+    if not os.path.isfile(file):
+        sys.stderr.write('file \'' + file + '\' not found\n')
+        sys.exit(1)
+
+    index = file + '.db'
+
+    if not os.path.exists(index) or os.path.getmtime(index) < os.path.getmtime(file):
+        print('indexing taxonomy...')
+        build_ott_index(file, index)
+
+    return sqlite3.connect(index, check_same_thread = False)
+
+
+# get the OTT id a name matches in the local taxonomy, or None
+def ott_lookup(query):
+    if ott_db is None:
+        return None
+
+    with ott_db_lock:
+        row = ott_db.execute('SELECT ott_id FROM names WHERE name = ?', (query,)).fetchone()
+    return row[0] if row else None
+
+
+# check whether the local taxonomy has a taxon for an OTT id that TNRS would match
+def ott_has_taxon(ott_id):
+    if ott_db is None:
+        return False
+
+    with ott_db_lock:
+        row = ott_db.execute('SELECT suppressed FROM taxa WHERE ott_id = ?', (ott_id,)).fetchone()
+    return row is not None and not row[0]
+
+
+# get the parent id and a taxon from the local taxonomy, in the same form as Open
+# Tree of Life's responses
+def ott_taxon(ott_id):
+    with ott_db_lock:
+        parent, name, rank, sourceinfo, uniqname = ott_db.execute(
+                'SELECT parent, name, rank, sourceinfo, uniqname FROM taxa WHERE ott_id = ?', (ott_id,)).fetchone()
+
+    return parent, {'ott_id' : ott_id, 'name' : name, 'rank' : rank, 'unique_name' : uniqname or name,
+            'tax_sources' : sourceinfo.split(',') if sourceinfo else []}
+
+
+# get a taxon and its lineage from the local taxonomy, in the same form as Open
+# Tree of Life's taxon_info
+def ott_taxon_info(ott_id):
+    parent, info = ott_taxon(ott_id)
+    info['lineage'] = []
+
+    while parent is not None:
+        parent, taxon = ott_taxon(parent)
+        info['lineage'] += [taxon]
+
+    return info
+
+
+# get exact matches for a name from the local taxonomy, in the same form as Open
+# Tree of Life's TNRS
+def ott_matches(query):
+    ott_id = ott_lookup(query)
+
+    if ott_id is None:
+        return []
+    return [{'taxon' : ott_taxon(ott_id)[1]}]
+
+
+# query Open Tree of Life's taxonomic resolution services with a list of names
+def otl_tnrs(names, do_approximate = True):
+    res = otl_post('https://api.opentreeoflife.org/v3/tnrs/match_names',
+            {'names' : names, 'do_approximate_matching' : do_approximate})
+    res.raise_for_status()
     return res
 
 
 # query Open Tree of Life's taxonomy
-def otl_taxon(query, wait_time = 600, ncbi = False):
-    contact_otl = True
+def otl_taxon(query, ncbi = False):
+    if ncbi:
+        res = otl_post('https://api.opentreeoflife.org/v3/taxonomy/taxon_info',
+                {'source_id' : 'ncbi:' + str(query), 'include_lineage' : True})
+    else:
+        res = otl_post('https://api.opentreeoflife.org/v3/taxonomy/taxon_info',
+                {"ott_id" : query, "include_lineage" : True})
+
+    if res.status_code == 400:
+        sys.stderr.write(res.json()['message'])
+        sys.stderr.write('skipping')
+        return None
+
+    res.raise_for_status()
+    return res
+
+
+# get exact TNRS matches for a single name
+@otl_cached('tnrs')
+def otl_matches(query):
+    results = otl_tnrs([query], do_approximate = False).json()['results']
+
+    if results:
+        return results[0]['matches']
+    return []
+
 
-    while contact_otl:
+# get exact TNRS matches for many names in batches of batch_size names per
+# request, storing them in otl_cache for otl_matches
+def prefetch_matches(names, batch_size = 100):
+    with otl_cache_lock:
+        names = [name for name in names if not otl_cache_has('tnrs:' + name) and not otl_cache_has('name:' + name)
+                and ott_lookup(name) is None]
+
+    for i in range(0, len(names), batch_size):
+        batch = names[i:i + batch_size]
+
+        # leave failed batches to be looked up one name at a time, which fails
+        # straight away if the batch used up its retries
         try:
-            if ncbi:
-                res = requests.post('https://api.opentreeoflife.org/v3/taxonomy/taxon_info',
-                        json = {'source_id' : 'ncbi:' + str(query), 'include_lineage' : True})
-            else:
-                res = requests.post('https://api.opentreeoflife.org/v3/taxonomy/taxon_info',
-                        json = {"ott_id" : query, "include_lineage" : True})
-        except (SSLError, ConnectionError):
-            sys.stderr.write(time.ctime() + ': error connecting to Open Tree of Life, retrying in ' + str(wait_time) + ' seconds')
-            time.sleep(wait_time)
+            res = otl_tnrs(batch, do_approximate = False)
+            matches = {result['name'] : result['matches'] for result in res.json()['results']}
+        except (RequestException, ValueError, KeyError):
             continue
 
-        if res.status_code == 200:
-            contact_otl = False
-        elif res.status_code == 400:
-            contact_otl = False
-            sys.stderr.write(res.json()['message'])
-            sys.stderr.write('skipping')
-            return None
-        else:
-            sys.stderr.write(time.ctime() + ': error contacting Open Tree of Life, retrying in ' + str(wait_time) + ' seconds')
-            time.sleep(wait_time)
-    return res
+        with otl_cache_lock:
+            for name in batch:
+                otl_cache_put('tnrs:' + name, matches.get(name, []))
 
 
 # get taxonomy up to order from a genus name
+@functools.lru_cache(maxsize = None)
+@otl_cached('ott')
 def taxonomy_OTT(ott_id = None):
-    res = otl_taxon(ott_id, wait_time = 3600)
-
-    # taxonomy dictionary
-    out_dict = {('tax_' + higher['rank']) : higher['name'] for higher in res.json()['lineage']}
+    if ott_has_taxon(ott_id):
+        payload = ott_taxon_info(ott_id)
+    else:
+        res = otl_taxon(ott_id)
+        if res is None:
+            return {}
+        payload = res.json()
+
+    # taxonomy dictionary and first lineage entry of each rank
+    out_dict = {}
+    by_rank = {}
+    for higher in payload['lineage']:
+        out_dict['tax_' + higher['rank']] = higher['name']
+        by_rank.setdefault(higher['rank'], higher)
     out_dict['tax_higher_source'] = 'OTT'
-    out_dict['rank'] = res.json()['rank']
+    out_dict['rank'] = payload['rank']
 
     # remove unnecessary ranks
     for rank in ['tax_no rank']:
@@ -105,22 +350,22 @@ def taxonomy_OTT(ott_id = None):
 
     # add OTT id and accepted name
     out_dict['tax_ott_id'] = ott_id
-    out_dict['tax_ott_accepted_name'] = res.json()['name']
+    out_dict['tax_ott_accepted_name'] = payload['name']
 
     # add NCBI id
     try:
-        out_dict.update({'tax_ncbi_id' : list2dict(res.json()['tax_sources'])['ncbi']})
+        out_dict.update({'tax_ncbi_id' : list2dict(payload['tax_sources'])['ncbi']})
     except KeyError:
         pass
 
     # add genus information for species or subspecies queries
-    if res.json()['rank'] in ['species', 'subspecies']:
+    if payload['rank'] in ['species', 'subspecies']:
         try:
-            genus_tax = [tax for tax in res.json()['lineage'] if tax['rank'] == 'genus'][0]
-        except IndexError:
-            out_dict['tax_cg_ott_id'] = nan
+            genus_tax = by_rank['genus']
+        except KeyError:
+            out_dict['tax_cg_ott_id'] = np.nan
             if out_dict['rank'] in ['species', 'subspecies']:
-                out_dict['cg'] = res.json()['unique_name'].split()[0]
+                out_dict['cg'] = payload['unique_name'].split()[0]
         else:
             out_dict['tax_cg_ott_id'] = genus_tax['ott_id']
             out_dict['cg'] = out_dict['tax_genus']
@@ -131,11 +376,8 @@ def taxonomy_OTT(ott_id = None):
                 pass
 
     # update species ids for subspecies queries
-    try:
-        species_tax = [tax for tax in res.json()['lineage'] if tax['rank'] == 'species'][0]
-        out_dict['tax_cs_ott_id'] = species_tax['ott_id']
-    except:
-        pass
+    if 'species' in by_rank:
+        out_dict['tax_cs_ott_id'] = by_rank['species']['ott_id']
 
     try:
         del out_dict['tax_species']
@@ -149,30 +391,31 @@ def taxonomy_OTT(ott_id = None):
 
 
 # get taxonomy information from a query
+@otl_cached('name')
 def otl_checkname(query):
-    outdict = None
+    matches = ott_matches(query) or otl_matches(query)
 
-    res = otl_tnrs(query, do_approximate = False)
+    if not matches:
+        return { }
 
-    if res.json()['results']:
-        if not res.json()['results'][0]['matches']:
-            return { }
+    result = matches[0]
+    outdict = {'current_name' : result['taxon']['name'], 'id' : result['taxon']['ott_id'], 'name_source' : 'OTT'}
 
-        result = res.json()['results'][0]['matches'][0]
-        outdict = {'current_name' : result['taxon']['name'], 'id' : result['taxon']['ott_id'], 'name_source' : 'OTT'}
-        outdict['higher_taxonomy'] = taxonomy_OTT(result['taxon']['ott_id'])
+    # the TNRS match has the name, rank and sources, so only look up the
+    # lineage for matches that will be used
+    if result['taxon']['rank'] == 'species':
+        outdict['level'] = 'species'
+        try:
+            outdict['ncbi_id'] = list2dict(result['taxon']['tax_sources'])['ncbi']
+        except:
+            pass
+    elif result['taxon']['rank'] == 'genus':
+        outdict['level'] = 'genus'
+    else:
+        warnings.warn(query + ': found in ott, but not as genus or species')
+        return None
 
-        if result['taxon']['rank'] == 'species':
-            outdict['level'] = 'species'
-            try:
-                outdict['ncbi_id'] = list2dict(result['taxon']['tax_sources'])['ncbi']
-            except:
-                pass
-        elif result['taxon']['rank'] == 'genus':
-            outdict['level'] = 'genus'
-        else:
-            warnings.warn(query + ': found in ott, but not as genus or species')
-            return None
+    outdict['higher_taxonomy'] = taxonomy_OTT(result['taxon']['ott_id'])
 
     return outdict
 
@@ -182,21 +425,19 @@ def read_data(file):
     try:
         with open(file, newline='') as csvfile:
             csvreader = csv.reader(csvfile)
-            header = [item for item in next(csvreader)]
+            header = next(csvreader)
             header_lower = [item.lower() for item in header]
             csvrows = list(csvreader)
     except FileNotFoundError:
         sys.stderr.write('file \'' + file + '\' not found\n')
         sys.exit(1)
 
-    csvcols = list(zip(*csvrows))
-
     # first column should be 'OTU'
     if header_lower[0] != 'otu':
         sys.stderr.write('no OTU column found\n')
         sys.exit(1)
 
-    species = [item.lower() for item in csvcols[0]]
+    species = [row[0].lower() for row in csvrows]
 
     # find 'control' column
     try:
@@ -205,75 +446,115 @@ def read_data(file):
         sys.stderr.write('no control column found\n')
         sys.exit(1)
 
-    controls = [int(item) for item in csvcols[control_col]]
+    # parse all count columns at once
+    counts = np.array([row[1:] for row in csvrows], dtype = np.int64)
+    controls = counts[:, control_col - 1]
 
     # find all experimental columns
-    data = [[int(row[i]) for i in range(1, len(row)) if i != control_col] for row in csvrows]
+    samples = [item for i, item in enumerate(header) if i not in (0, control_col)]
+    data = np.delete(counts, control_col - 1, axis = 1)
 
-    return header, species, controls, data
+    return samples, species, controls, data
 
 
-# process data
-def process_data(species, controls, data):
-    species_processed = []
-    data_processed = []
+# get a name followed by each less specific name made by dropping its last word
+def name_candidates(sp):
+    candidates = [sp]
 
-    # prune counts below cutoff
-    for i in range(len(data)):
-        data_processed += [[]]
-        for j in range(len(data[i])):
-            if controls[i] and data[i][j] / controls[i] <= PRUNING_VALUE:
-                data_processed[i] += [0]
-            else:
-                data_processed[i] += [data[i][j]]
+    while ' ' in candidates[-1]:
+        candidates += [candidates[-1].rsplit(' ', 1)[0]]
 
-    # get sums of pruned counts
-    sums = [sum(i) for i in list(zip(*data_processed))]
+    return candidates
 
-    # get proportions
-    for i in range(len(data_processed)):
-        for j in range(len(data_processed[i])):
-            data_processed[i][j] = data_processed[i][j] / sums[j]
 
-    # get taxonomy data
-    for sp in species:
-        name = [sp]
-        species_processed += [[]]
+# get taxonomy row for a species, falling back to less specific names
+def check_species(sp):
+    row = ['-'] * 7
+    taxa = None
 
-        taxa = otl_checkname(sp)
+    try:
+        for name in name_candidates(sp):
+            taxa = otl_checkname(name)
+            if taxa:
+                break
+    except RequestException:
+        if not otl_unavailable.is_set():
+            warnings.warn(sp + ': error contacting Open Tree of Life, leaving unresolved')
+        taxa = None
+
+    if taxa:
+        for i, key in enumerate(['tax_domain', 'tax_kingdom', 'tax_phylum', 'tax_class', 'tax_order', 'tax_family']):
+            try:
+                row[i] = taxa['higher_taxonomy'][key]
+            except KeyError:
+                pass
 
-        while not taxa and ' ' in name[0]:
-            name = name[0].rsplit(' ', 1) + name[1:]
-            taxa = otl_checkname(name[0])
+        row[-1] = taxa['current_name']
 
-        if taxa:
-            for key in ['tax_domain', 'tax_kingdom', 'tax_phylum', 'tax_class', 'tax_order', 'tax_family']:
-                try:
-                    species_processed[-1] += [taxa['higher_taxonomy'][key]]
-                except KeyError:
-                    species_processed[-1] += ['-']
+        # keep the words dropped to find a match
+        if name != sp:
+            row[-1] += ' ' + sp[len(name) + 1:]
 
-            species_processed[-1] += [taxa['current_name']]
+    else:
+        row[-1] = sp
 
-            if len(name) > 1:
-                species_processed[-1][-1] += ' ' + ' '.join(name[1:])
+    return row
 
-        else:
-            species_processed[-1] += ['-', '-', '-', '-', '-', '-', sp]
+
+# process data
+def process_data(species, controls, data, samples = None):
+    controls = np.asarray(controls, dtype = np.int64)
+    data = np.asarray(data, dtype = np.int64)
+
+    # prune counts below cutoff
+    pruned = data.astype(np.float64)
+    pruned[(controls[:, None] != 0) & (data <= PRUNING_VALUE * controls[:, None])] = 0
+
+    # OTUs pruned to zero in every sample are not looked up
+    kept = pruned.any(axis = 1)
+
+    # samples pruned to zero have no proportions
+    sums = pruned.sum(axis = 0)
+    empty = np.flatnonzero(sums == 0)
+    for j in empty:
+        sample = samples[j] if samples else str(j + 1)
+        sys.stderr.write('no counts left after pruning in sample \'' + sample + '\'\n')
+    if empty.size:
+        sys.exit(1)
+
+    # get proportions of pruned counts in place
+    pruned /= sums
+    data_processed = pruned
+
+    # get taxonomy data, looking up each distinct kept species once
+    unique_species = sorted({sp for sp, keep in zip(species, kept) if keep})
+
+    # match every species and fallback name in batched requests up front
+    prefetch_matches(sorted({name for sp in unique_species for name in name_candidates(sp)}))
+
+    # look up species on a few threads at once to limit load on Open Tree of Life;
+    # the connection pool is larger so threads never wait for a connection
+    with concurrent.futures.ThreadPoolExecutor(max_workers = OTL_MAX_REQUESTS) as executor:
+        taxa_map = dict(zip(unique_species, executor.map(check_species, unique_species)))
+
+    # OTUs pruned everywhere still share the taxonomy of kept OTUs of the same name
+    species_processed = [taxa_map.get(sp, ['-'] * 6 + [sp]) for sp in species]
 
     return species_processed, data_processed
 
 
 # write processed data to csv file
-def write_data(file, header, species, data):
+def write_data(file, samples, species, data):
     with open(file, 'w') as csvfile:
         csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(['domain', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus, species'] + header[1:-1])
+        csvwriter.writerow(['domain', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus, species'] + samples)
 
-        combined = [species[i] + data[i] for i in range(len(species))]
-        combined.sort()
+        # sort rows by taxonomy only
+        order = sorted(range(len(species)), key = species.__getitem__)
 
-        csvwriter.writerows(combined)
+        # convert the proportions to lists in one pass
+        rows = data.tolist()
+        csvwriter.writerows(species[i] + rows[i] for i in order)
 
 
 if __name__ == '__main__':
@@ -285,11 +566,21 @@ if __name__ == '__main__':
         sys.stderr.write('no output file give\n')
         sys.exit(1)
 
-    header, species, controls, data = read_data(sys.argv[1])
+    samples, species, controls, data = read_data(sys.argv[1])
+
+    if OTT_TAXONOMY_FILE:
+        print('loading taxonomy...')
+        ott_db = open_ott_taxonomy(OTT_TAXONOMY_FILE)
 
     print('processing...')
 
-    species_processed, data_processed = process_data(species, controls, data)
-    write_data(sys.argv[2], header, species_processed, data_processed)
+    otl_cache = open_otl_cache(OTL_CACHE_FILE)
+    try:
+        species_processed, data_processed = process_data(species, controls, data, samples)
+    finally:
+        otl_cache.commit()
+        otl_cache.close()
+
+    write_data(sys.argv[2], samples, species_processed, data_processed)
 
     print('done.')